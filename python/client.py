@@ -1,19 +1,27 @@
 #!/bin/python3
 
-from conf import analyse_args, CLIENT_PORT, SERVER_PORT, MAX_PACKET_SIZE
+from conf import analyse_args, CLIENT_PORT, SERVER_PORT
 import conf
 import socket
-import select
 import getopt
 import sys
 import os.path
+import contextlib
 import random
+import stat
+import time
 
+import rxring
 import smfsp
 
 verbose = False
 server_broadcast = ('255.255.255.255', SERVER_PORT)
 download_timeout = 0.010    # 10 ms
+# consecutive timeouts before asking servers for a
+# fresh hello, which tells whether the file changed
+stall_hello = 10
+# swarm mode: re-serve downloaded chunks to other clients
+swarm = False
 
 
 sock = socket.socket(
@@ -24,62 +32,272 @@ broad_sock = socket.socket(
     socket.AF_INET,
     socket.SOCK_DGRAM | socket.SOCK_NONBLOCK)
 sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+broad_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+# swarm mode only: receive requests sent to servers
+peer_sock = socket.socket(
+    socket.AF_INET,
+    socket.SOCK_DGRAM | socket.SOCK_NONBLOCK)
+peer_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+# same as broad_sock and peer_sock for messages in
+# smfsp.EXT_TYPES
+ext_sock = socket.socket(
+    socket.AF_INET,
+    socket.SOCK_DGRAM | socket.SOCK_NONBLOCK)
+ext_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+peer_ext_sock = socket.socket(
+    socket.AF_INET,
+    socket.SOCK_DGRAM | socket.SOCK_NONBLOCK)
+peer_ext_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+# receive engine, created once sockets are bound
+receiver = None
 
-def receive_from(sock_list, timeout=1.0, bufsz = MAX_PACKET_SIZE):
-    s, _, _ = select.select(sock_list, [], [], timeout)
-    for sock in s:
+# Swarm mode: send all scheduled answers whose
+# backoff has expired
+#
+# f:        file being downloaded, opened for reading
+# answers:  dict{cnk_idx => (due time, codecs, offer type)}
+# file_id:  id of the file, used to answer with CNK_OFFER_ID
+def serve_peers(f, answers, remote_file, expected_size, file_id=None, version=0,
+        max_chunk_sz=conf.DEFAULT_CHUNK_SIZE):
+    now = time.monotonic()
+    for cnk_idx, (due, codecs, offer_type) in list(answers.items()):
+        if due > now:
+            continue
+        del answers[cnk_idx]
+        cnk_offset = cnk_idx*max_chunk_sz
+        last_cnk = expected_size <= cnk_offset+max_chunk_sz
+        cnk_sz = expected_size - cnk_offset if last_cnk else max_chunk_sz
+        f.seek(cnk_offset)
+        codec, payload = smfsp.encode_chunk(f.read(cnk_sz), codecs)
         if verbose:
-            print(f"Reading data from sock: {sock.getsockname()}")
-        bytes, address = sock.recvfrom(bufsz)
-        return (bytes, address, sock)
-    return (None, None, None)
-    #raise Exception("Timeout!")
-
-def handle_download(remote_file, download_location, expected_size):
-    max_chunk_sz = conf.DEFAULT_CHUNK_SIZE
+            print(f"Serving chunk {cnk_idx} to peers")
+        dest = smfsp.destination(offer_type, conf.CLIENT_BROADCAST, conf.CLIENT_EXT_PORT)
+        smfsp.send_chunk_payload(sock, dest, remote_file,
+            expected_size, cnk_offset, cnk_sz, last_cnk, codec, payload,
+            offer_type=offer_type, file_id=file_id, version=version)
+
+# CHUNK SELECTION STRATEGIES
+# Choose which chunks to ask in the next request
+#
+# missing:  set of chunks not received yet
+# pending:  set of chunks already requested
+# count:    maximum number of chunks to choose
+# state:    dict kept along the whole download
+#   'nchunks':  number of chunks of the file
+#   'demand':   dict{cnk_idx => number of requests from
+#               other clients overheard (swarm mode)}
+#   'window':   sequential only, how far from the first
+#               missing chunk it can go
+#   'pools':    rarest only, dict{demand => list of chunks},
+#               see add_demand()
+#
+# return list of chunks
+
+# randomly choices a subset of the chunks
+def select_random(missing, pending, count, state):
+    candidates = list(missing - pending)
+    return random.sample(candidates, min(count, len(candidates)))
+
+# first missing chunks, in order
+def select_sequential(missing, pending, count, state):
+    # first missing chunk only moves forward
+    base = state.get('base', 0)
+    while base < state['nchunks'] and base not in missing:
+        base += 1
+    state['base'] = base
+    ans = []
+    for cnk_idx in range(base, min(base + state.get('window', state['nchunks']), state['nchunks'])):
+        if len(ans) >= count:
+            break
+        if cnk_idx in missing and cnk_idx not in pending:
+            ans.append(cnk_idx)
+    return ans
+
+# record a request for a chunk overheard from another client
+def add_demand(state, cnk_idx):
+    level = state['demand'].get(cnk_idx, 0) + 1
+    state['demand'][cnk_idx] = level
+    if 'pools' in state:
+        state['pools'].setdefault(level, []).append(cnk_idx)
+
+# runs of adjacent chunks from random positions, chunks
+# requested by other clients come last: they are going
+# to be broadcast anyway
+#
+# Chunks are bucketed by demand. Buckets are never
+# rebuilt: received chunks and chunks whose demand has
+# grown are removed when found, so each call costs
+# about the number of chunks returned.
+def select_rarest(missing, pending, count, state):
+    demand = state['demand']
+    if 'pools' not in state:
+        state['pools'] = {0: list(range(state['nchunks']))}
+        for cnk_idx, level in demand.items():
+            state['pools'].setdefault(level, []).append(cnk_idx)
+    pools = state['pools']
+    ans = []
+    chosen = set()
+    for level in sorted(pools):
+        pool = pools[level]
+        # bound the work when only pending chunks are left
+        misses = 0
+        while len(pool) > 0 and len(ans) < count and misses < 4*count:
+            i = random.randrange(len(pool))
+            cnk_idx = pool[i]
+            if cnk_idx not in missing or demand.get(cnk_idx, 0) != level:
+                # stale entry, remove it
+                pool[i] = pool[-1]
+                pool.pop()
+                continue
+            start = len(ans)
+            while len(ans) < count and cnk_idx in missing \
+                    and demand.get(cnk_idx, 0) == level \
+                    and cnk_idx not in pending and cnk_idx not in chosen:
+                ans.append(cnk_idx)
+                chosen.add(cnk_idx)
+                cnk_idx += 1
+            if len(ans) == start:
+                misses += 1
+        if len(pool) == 0:
+            del pools[level]
+        if len(ans) >= count:
+            break
+    return ans
+
+STRATEGIES = {
+    'random': select_random,
+    'sequential': select_sequential,
+    'rarest': select_rarest,
+}
+
+# Download a file
+#
+# download_location:    path of the file to write
+# strategy:             name of the chunk selection strategy
+# stream:               if not None, file object where the
+#       content is written in order as soon as available,
+#       download_location is then ignored
+# file_id, version, cnk_size:   as announced by SRV_HELLO_ID,
+#       if file_id is given compact messages are used
+def handle_download(remote_file, download_location, expected_size,
+        strategy=conf.DEFAULT_STRATEGY, stream=None, file_id=None, version=0,
+        cnk_size=conf.COMPACT_CHUNK_SIZE):
+    # compact transfers use the chunk size chosen by the server
+    max_chunk_sz = conf.DEFAULT_CHUNK_SIZE if file_id is None else cnk_size
     # calculate number of chunk to download
     Nchunks = (expected_size + max_chunk_sz-1)//max_chunk_sz
 
     # set of chunks to be required
-    all_chunks = list(range(Nchunks))
+    all_chunks = set(range(Nchunks))
+
+    # does a packet refer to the downloaded file?
+    def same_file(content):
+        if 'id' in content:
+            return content['id'] == file_id and content['version'] == version
+        # chunks of compact transfers have a different size
+        return file_id is None and content['name'] == remote_file and content['size'] == expected_size
+
+    # does a SRV_HELLO_ID entry or a CNK_OFFER_ID announce a
+    # new version? Servers drop requests for old versions
+    def changed(info):
+        return file_id is not None and info['id'] == file_id and info['version'] != version
 
     # chunks required in a single iteration
     some_chunks = []
+    select_chunks = STRATEGIES[strategy]
+    select_state = {
+        'nchunks': Nchunks,
+        'demand': {},
+    }
+    # streaming: first chunk not written yet and
+    # chunks received out of order
+    next_write = 0
+    reorder = {}
+    if stream is not None:
+        # only chunks that can be buffered are requested
+        select_chunks = select_sequential
+        select_state['window'] = conf.STREAM_REORDER_CHUNKS
+    # swarm mode: chunks already written to the file
+    # and answers scheduled for other clients
+    received = set()
+    answers = {}
+    # timeouts since the last chunk received
+    stalls = 0
+    # wait longer, servers defer their answers
+    timeout = download_timeout + conf.ORIGIN_DEFER if swarm else download_timeout
     # create file that will store the content
-    with open(download_location, 'wb') as f:
+    # (readable too, in order to serve peers)
+    with open(download_location, 'w+b') if stream is None else contextlib.nullcontext(stream) as f:
         # repeat until the whole file has beed download
         while len(all_chunks) > 0:
             # in every loop, sent a request to the server
             # listing some chunks and wait for them
 
-            # RANDOM APPROACH - randomly choices a subset
-            # of the chunks
             # select chunks to require
-            some_chunks += random.sample(all_chunks,
-                min(conf.MAX_CHUNKS_PER_REQ, len(all_chunks))-len(some_chunks))
+            some_chunks += select_chunks(all_chunks, set(some_chunks),
+                conf.MAX_CHUNKS_PER_REQ-len(some_chunks), select_state)
             # sort to be cache friendly
             some_chunks.sort()
             # send request to server
-            smfsp.send_chunk_list_req(sock, server_broadcast,
-                remote_file,
-                expected_size,
-                some_chunks)
+            if file_id is None:
+                # the file may come from an old server,
+                # send an old request
+                smfsp.send_chunk_list_req(sock, server_broadcast,
+                    remote_file,
+                    expected_size,
+                    some_chunks,
+                    codecs=None)
+            else:
+                smfsp.send_chunk_list_req_by_id(sock,
+                    smfsp.destination(smfsp.CNK_LIST_REQ_ID, server_broadcast, conf.SERVER_EXT_PORT),
+                    file_id,
+                    version,
+                    some_chunks)
             if verbose:
                 print("Sent request for chunks:", some_chunks)
             
             # wait for server response
+            deadline = time.monotonic() + timeout
             while len(some_chunks) > 0:
-                bytes, _, _ = receive_from([sock, broad_sock], timeout=download_timeout)
+                # handle queued packets first: they may
+                # be answers sent by other peers
+                if len(answers) > 0 and not receiver.pending:
+                    serve_peers(f, answers, remote_file, expected_size, file_id, version, max_chunk_sz)
+                wait = deadline - time.monotonic()
+                if len(answers) > 0:
+                    wait = min(wait, min(a[0] for a in answers.values()) - time.monotonic())
+                bytes, _, _ = receiver.receive(timeout=max(0, wait))
+                msg_type, content = (None, None) if bytes == None else smfsp.parse_packet(bytes)
                 # if timeout bread and query again the server
-                if bytes == None:
+                if msg_type == None:
+                    if time.monotonic() < deadline:
+                        continue    # some answer to peers is due
                     if verbose:
                         print("Timeout! Missing:   ", some_chunks)
                         print("Timeout! all_chunks:", all_chunks)
+                        print("Packets dropped by the kernel:", receiver.dropped())
+                    stalls += 1
+                    if stalls % stall_hello == 0:
+                        smfsp.send_client_hello(sock, server_broadcast)
                     break   # if it timeouts, it resend a chunk request
-                msg_type, content = smfsp.parse_packet(bytes)
+                deadline = time.monotonic() + timeout
                 if verbose:
                     print(f"Received {smfsp.type2name(msg_type)} packet: {content}")
-                if msg_type != smfsp.CNK_OFFER:
+                if msg_type == smfsp.SRV_HELLO_ID or msg_type == smfsp.CNK_OFFER_ID:
+                    for info in content if msg_type == smfsp.SRV_HELLO_ID else [content]:
+                        if changed(info):
+                            raise Exception(f"File {remote_file} changed on the server during the download")
+                if msg_type in smfsp.OFFER_FOR_REQ and swarm:
+                    # another client is asking for chunks,
+                    # answer if nobody else does it first
+                    if same_file(content):
+                        for cnk_idx in content['cnk_list']:
+                            if cnk_idx in all_chunks:
+                                add_demand(select_state, cnk_idx)
+                            elif cnk_idx in received and cnk_idx not in answers:
+                                answers[cnk_idx] = (time.monotonic() + random.uniform(0, conf.PEER_BACKOFF),
+                                    content['codecs'], smfsp.OFFER_FOR_REQ[msg_type])
+                elif msg_type not in smfsp.OFFER_FOR_REQ.values():
                     # receive unwanted packet
                     pass
                     # do nothing - may cause starvation - should be
@@ -89,32 +307,44 @@ def handle_download(remote_file, download_location, expected_size):
                         print("Received CHUNK!")
                     # check correct chunk
                     # salva il chunk
-                    description = {
-                        'name': content['name'],
-                        'size': content['size'],
-                        'cnk_offset': content['cnk_offset'],
-                        'cnk_size': content['cnk_size'],
-                        'last_cnk': content['last_cnk'],
-                    }
+                    description = {k: v for k,v in content.items() if k != 'data'}
                     print(f"Received chunk for {description}")
                     # check if it was expected
-                    if content['name'] == remote_file and content['size'] == expected_size:
+                    if same_file(content):
                         # chunk of the requested packet
                         # were we waiting for it?
                         cnk_idx = content['cnk_offset'] // max_chunk_sz
-                        if cnk_idx in all_chunks:
+                        # someone else answered
+                        answers.pop(cnk_idx, None)
+                        if stream is not None and cnk_idx >= next_write + conf.STREAM_REORDER_CHUNKS:
+                            # no room to keep it
+                            if verbose:
+                                print(f"Chunk {cnk_idx} outside reorder window, dropped")
+                        elif cnk_idx in all_chunks:
                             # assert valid chunk size
                             if content['last_cnk'] and content['cnk_offset']+content['cnk_size'] != expected_size:
                                 raise Exception(f"Invalid last chunk: offset: {content['cnk_offset']} cnk_size: {content['cnk_size']} file_size: {expected_size}")
-                            elif not content['last_cnk'] and content['cnk_size'] != conf.DEFAULT_CHUNK_SIZE:
-                                raise Exception(f"Invalid chunk size: {content['cnk_size']} instead of {conf.DEFAULT_CHUNK_SIZE}")
+                            elif not content['last_cnk'] and content['cnk_size'] != max_chunk_sz:
+                                raise Exception(f"Invalid chunk size: {content['cnk_size']} instead of {max_chunk_sz}")
 
                             # chunk is then valid, so write it
-                            f.seek(content['cnk_offset'])
-                            f.write(content['data'])
+                            if stream is None:
+                                f.seek(content['cnk_offset'])
+                                f.write(content['data'])
+                                received.add(cnk_idx)
+                            else:
+                                # data refers to the receive buffer
+                                reorder[cnk_idx] = bytearray(content['data'])
+                                # write the contiguous prefix
+                                while next_write in reorder:
+                                    f.write(reorder.pop(next_write))
+                                    next_write += 1
+                                f.flush()
 
                             # remove chunk from expected
                             all_chunks.remove(cnk_idx)
+                            stalls = 0
+                            select_state['demand'].pop(cnk_idx, None)
                             if cnk_idx in some_chunks:
                                 some_chunks.remove(cnk_idx)
                         else:
@@ -126,15 +356,32 @@ def handle_download(remote_file, download_location, expected_size):
         print("File fully received!")
 
 
+# is path a pipe or a device, where the download
+# has to be written in order?
+def is_stream(path):
+    try:
+        mode = os.stat(path).st_mode
+    except FileNotFoundError:
+        return False
+    return stat.S_ISFIFO(mode) or stat.S_ISCHR(mode)
+
 # handle interaction with user to download requested file
-# fileitem: dict{'size', 'name', 'server'}
-def download_file(fileItem):
+# fileitem: dict{'size', 'name', 'server'[, 'id', 'version', 'cnk_size']}
+# output:   None to ask the user, otherwise path or
+#           binary file object where to write the file
+def download_file(fileItem, strategy=conf.DEFAULT_STRATEGY, output=None):
     remote_file = fileItem['name']
     remote_srvr = fileItem['server']
     expected_size = fileItem['size']
     download_location = os.path.abspath(remote_file)
     print(f"Download file {remote_file} from server {remote_srvr}")
-    ok = False
+    stream = None
+    if isinstance(output, str):
+        download_location = os.path.abspath(output)
+    elif output is not None:
+        stream = output
+        download_location = getattr(output, 'name', 'stream')
+    ok = output is not None
     while not ok:
         name_ok= False
         while not name_ok:
@@ -145,7 +392,7 @@ def download_file(fileItem):
                 name_ok = True
             else:
                 download_location = os.path.abspath(candidate)
-        if os.path.exists(download_location):
+        if os.path.exists(download_location) and not is_stream(download_location):
             print(f"File '{download_location}' already exists, are you SURE to overwrite it? [y/N] ", end='')
             candidate = input().strip().lower()
             if candidate == 'y':
@@ -158,18 +405,47 @@ def download_file(fileItem):
     print(f"Downloadind file {remote_file} to {download_location}...")
 
     # start the download
-    handle_download(remote_file, download_location, expected_size)
+    if stream is None and is_stream(download_location):
+        # pipes cannot seek: write in order
+        with open(download_location, 'wb') as pipe:
+            handle_download(remote_file, download_location, expected_size, strategy, pipe,
+                fileItem.get('id'), fileItem.get('version', 0),
+            fileItem.get('cnk_size', conf.COMPACT_CHUNK_SIZE))
+    else:
+        handle_download(remote_file, download_location, expected_size, strategy, stream,
+            fileItem.get('id'), fileItem.get('version', 0),
+            fileItem.get('cnk_size', conf.COMPACT_CHUNK_SIZE))
 
 
 def main():
     global verbose
     global server_broadcast
+    global receiver
+    global swarm
 
     # parse options
-    optlist, _ = getopt.gnu_getopt(sys.argv[1:], 'p:i:v')
+    optlist, _ = getopt.gnu_getopt(sys.argv[1:], 'p:i:vsc:o:f:')
     # parse arguments
     opts = analyse_args(optlist, isserver=False)
     verbose = opts["verbose"]
+    swarm = opts["swarm"]
+    if opts['strategy'] not in STRATEGIES:
+        raise Exception("Unknown strategy: " + opts['strategy'])
+    output = opts['output']
+    # file to download without asking the user
+    wanted = opts['file']
+    if output == '-':
+        # stream the download on stdout, all
+        # messages go to stderr
+        output = sys.stdout.buffer
+        sys.stdout = sys.stderr
+    if wanted is None and output is not None and \
+            (not isinstance(output, str) or is_stream(output)):
+        # nobody can answer the prompts
+        raise Exception("Streaming output requires choosing the file with -f")
+    if wanted is not None and output is None:
+        # default location, no questions asked
+        output = wanted
 
     # everithing has been checked, bind socket
     binding = (opts['bind_addr'], opts['bind_port'])
@@ -179,8 +455,23 @@ def main():
     if verbose:
         print("Try to bind broadcast socket")
     broad_sock.bind(('<broadcast>', opts['bind_port']))
+    if verbose:
+        print("Try to bind extension socket")
+    ext_sock.bind(('<broadcast>', conf.CLIENT_EXT_PORT))
+    socket_list = [sock, broad_sock, ext_sock]
+    if swarm:
+        if verbose:
+            print("Try to bind sockets to serve peers")
+        peer_sock.bind(('<broadcast>', SERVER_PORT))
+        peer_ext_sock.bind(('<broadcast>', conf.SERVER_EXT_PORT))
+        socket_list += [peer_sock, peer_ext_sock]
     if verbose:
         print("All sockets bound!")
+    # in swarm mode own requests are overheard too,
+    # they must not count as demand of other peers
+    receiver = rxring.Receiver(socket_list, ignore=[rxring.source_address(sock, server_broadcast)])
+    if verbose:
+        print("Socket receive buffers:", list(receiver.rcvbuf.values()))
 
     smfsp.send_client_hello(sock, server_broadcast)
     print()
@@ -188,13 +479,21 @@ def main():
         print("Client test loop:")
     hello_received = False
     available_files = {}
-    print("Send ^C to stop or chose file to download")
+    if wanted is None:
+        print("Send ^C to stop or chose file to download")
+    else:
+        print(f"Waiting for a server offering {wanted}")
     print("C")
     try:
         while True:
-            bytes, address, _ = receive_from([sock, broad_sock], timeout=None)
+            bytes, address, _ = receiver.receive(timeout=None)
             print('\treceived packet from:', address)
-            msg_type, content = smfsp.parse_packet(bytes)
+            try:
+                msg_type, content = smfsp.parse_packet(bytes)
+            except Exception as e:
+                # malformed or unknown packet, drop it
+                print(f"Dropped packet from {address}: {e}")
+                continue
             print('\tType:', smfsp.type2name(msg_type))
             print('\tData:', content)
             print()
@@ -207,7 +506,27 @@ def main():
                             'server': address,
                         }
                 hello_received = True
-                print("Interrupt to choose file to download")
+            elif msg_type == smfsp.SRV_HELLO_ID:
+                for info in content:
+                    known = available_files.get(info['name'])
+                    # prefer compact messages
+                    if known is None or 'id' not in known:
+                        available_files[info['name']] = {
+                            'name': info['name'],
+                            'size': info['size'],
+                            'server': address,
+                            'id': info['id'],
+                            'version': info['version'],
+                            'cnk_size': info['cnk_size'],
+                        }
+                hello_received = True
+            else:
+                continue
+            if wanted in available_files and not receiver.pending:
+                # first server offering the file, queued
+                # hellos may carry its SRV_HELLO_ID
+                break
+            print("Interrupt to choose file to download")
     except KeyboardInterrupt:
         if hello_received:
             decided = False
@@ -233,11 +552,13 @@ def main():
                     else:
                         print("Discarded, repeat")
             
-            download_file(l[index])
+            download_file(l[index], opts['strategy'], output)
                     
         else:
             print("Interrupted without having received any file to download, exit")
             exit(0)
+    else:
+        download_file(available_files[wanted], opts['strategy'], output)
     
 
 
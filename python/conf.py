@@ -8,6 +8,12 @@ CLIENT_PORT = 5051
 
 CLIENT_BROADCAST = ('255.255.255.255', CLIENT_PORT)
 
+# messages old clients and servers do not understand
+# (smfsp.EXT_TYPES) are sent only to these ports, old
+# peers never listen on them
+SERVER_EXT_PORT = 5052
+CLIENT_EXT_PORT = 5053
+
 # address to send packet to
 IPv4_BRD = '255.255.255.255'
 
@@ -15,12 +21,71 @@ IPv4_BRD = '255.255.255.255'
 MAX_PACKET_SIZE = 1400
 # maximum amount of file data in a single packet
 DEFAULT_CHUNK_SIZE = 1024
+# chunk size of transfers using CNK_OFFER_ID, it fills a
+# MAX_PACKET_SIZE datagram: magic + type + id + version
+# + chunk header take 40 bytes, a SHA-256 trailer 36
+COMPACT_CHUNK_SIZE = MAX_PACKET_SIZE - 40 - 36
 # maximum number of chunks requested in a single
 # request message sent by clients to a server
 MAX_CHUNKS_PER_REQ = 128
+# number of preallocated receive buffers, it is also
+# the maximum number of datagrams read per wakeup
+RX_RING_SLOTS = 256
+# requested size of socket receive buffers, the kernel
+# may cap it (see net.core.rmem_max)
+RX_SOCKET_BUFFER = 4*1024*1024
+# periodic SRV_HELLO interval, it grows up to
+# HELLO_MAX_INTERVAL while the server is busy
+HELLO_MIN_INTERVAL = 1.0
+HELLO_MAX_INTERVAL = 30.0
+# the server is busy when it receives more than
+# HELLO_BUSY_RATE CLN_HELLO and chunk requests per second
+HELLO_BUSY_RATE = 10.0
+# replies to CLN_HELLO are delayed by a random amount
+# up to HELLO_REPLY_DELAY and coalesced in one broadcast
+HELLO_REPLY_DELAY = 0.5
+# clients not listening on CLIENT_PORT miss the broadcast,
+# up to HELLO_MAX_UNICAST of them per reply get a copy
+HELLO_MAX_UNICAST = 16
+# minimum time between two SRV_HELLO, whatever the
+# number of clients
+HELLO_MIN_GAP = 0.2
+# while old clients are around, servers send both
+# SRV_HELLO_ID and the old SRV_HELLO
+LEGACY_HELLO = True
+# SWARM MODE
+# clients re-serving chunks wait a random time up to
+# PEER_BACKOFF before answering a CNK_LIST_REQ, an answer
+# overheard in the meanwhile cancels their own
+PEER_BACKOFF = 0.02
+# the origin server waits ORIGIN_DEFER before sending a
+# chunk, giving peers the chance to answer first
+ORIGIN_DEFER = 0.05
+# maximum amount of memory used by the server to keep
+# ready to send CNK_OFFER datagrams of hot chunks
+DATAGRAM_CACHE_BYTES = 32*1024*1024
+# ask the kernel to prefetch requested chunks
+# (only where os.posix_fadvise is available)
+FADVISE_WILLNEED = True
+# default client chunk selection strategy
+DEFAULT_STRATEGY = 'random'
+# streaming downloads keep at most this many out of
+# order chunks in memory waiting for the missing ones
+STREAM_REORDER_CHUNKS = 4*MAX_CHUNKS_PER_REQ
+# upper bound for the decoded size of a chunk, used
+# to refuse compressed payloads that would expand
+# beyond any reasonable chunk size
+MAX_DECODED_CHUNK_SIZE = 64*1024
+# zlib/lzma compression levels used by the server
+ZLIB_LEVEL = 6
+LZMA_PRESET = 6
 
 def analyse_args(optlist, isserver=False):
     verbose = False
+    swarm = False
+    strategy = DEFAULT_STRATEGY
+    output = None
+    file = None
     bind_addr = '127.0.0.1'
     bind_port = SERVER_PORT if isserver else CLIENT_PORT
     for k,v in optlist:
@@ -30,10 +95,22 @@ def analyse_args(optlist, isserver=False):
             bind_addr = ipaddress.ip_address(v).__str__()
         elif k == '-v':
             verbose = True
+        elif k == '-s':
+            swarm = True
+        elif k == '-c':
+            strategy = v
+        elif k == '-o':
+            output = v
+        elif k == '-f':
+            file = v
         else:
             raise Exception("Unrecognised option: " + k)
     return {
         'verbose': verbose,
+        'swarm': swarm,
+        'strategy': strategy,
+        'output': output,
+        'file': file,
         'bind_addr': bind_addr,
         'bind_port': bind_port,
     }
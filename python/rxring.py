@@ -0,0 +1,138 @@
+
+import collections
+import select
+import socket
+import struct
+import sys
+
+import conf
+
+# not exported by the socket module, value taken
+# from <asm-generic/socket.h>
+SO_RXQ_OVFL = getattr(socket, 'SO_RXQ_OVFL', 40)
+# SO_RXQ_OVFL is reported as an uint32 control message
+OVFL_CMSG_SPACE = socket.CMSG_SPACE(4)
+
+# Try to enlarge the receive buffer of a socket
+# to the requested size
+#
+# return the size actually granted by the kernel
+def tune_rcvbuf(s, size=conf.RX_SOCKET_BUFFER):
+    # SO_RCVBUFFORCE ignores rmem_max but requires
+    # CAP_NET_ADMIN, fallback to SO_RCVBUF
+    try:
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUFFORCE, size)
+    except (AttributeError, OSError):
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, size)
+    return s.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF)
+
+# Enable kernel drop counters on a socket
+#
+# return True if supported
+def enable_drop_counter(s):
+    if not sys.platform.startswith('linux'):
+        return False
+    try:
+        s.setsockopt(socket.SOL_SOCKET, SO_RXQ_OVFL, 1)
+    except OSError:
+        return False
+    return True
+
+
+# Address seen by peers as source of the packets sent
+# through socket s to dest
+def source_address(s, dest):
+    addr, port = s.getsockname()
+    if addr == '0.0.0.0':
+        # ask the kernel which local address is used
+        # to reach the destination
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as probe:
+            probe.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+            probe.connect(dest)
+            addr = probe.getsockname()[0]
+    return (addr, port)
+
+
+# Receive engine for a list of non blocking sockets.
+#
+# Every wakeup drains all datagrams queued on the ready
+# sockets into a ring of preallocated buffers, so no
+# allocation is done per packet.
+#
+# receive() returns memoryviews over the ring: the content
+# of a returned packet is valid until the ring is
+# refilled, i.e. until a following receive() call
+# finds no more queued packets.
+#
+# Datagrams sent from an address in ignore (e.g. own
+# broadcasts looped back) are discarded while draining.
+class Receiver:
+    def __init__(self, sock_list, slots=conf.RX_RING_SLOTS,
+            bufsz=conf.MAX_PACKET_SIZE, rcvbuf=conf.RX_SOCKET_BUFFER, ignore=()):
+        self.sock_list = sock_list
+        self.ignore = set(ignore)
+        self.ring = [memoryview(bytearray(bufsz)) for _ in range(slots)]
+        self.next_slot = 0
+        # packets received but not yet returned
+        # (data, address, sock)
+        self.pending = collections.deque()
+        # receive buffer size granted to each socket
+        self.rcvbuf = {}
+        # sockets reporting drop counters and last value
+        self.drops = {}
+        for s in sock_list:
+            self.rcvbuf[s] = tune_rcvbuf(s, rcvbuf)
+            if enable_drop_counter(s):
+                self.drops[s] = 0
+
+    # number of datagrams dropped by the kernel
+    # because receive buffers were full
+    def dropped(self):
+        return sum(self.drops.values())
+
+    # read a datagram of a non blocking socket into buf,
+    # updating drop counters and skipping ignored senders
+    #
+    # return tuple
+    #   (nbytes, address)
+    # raise BlockingIOError if no datagram is queued
+    def recv_into(self, s, buf):
+        count_drops = s in self.drops
+        while True:
+            if count_drops:
+                nbytes, ancdata, _, address = s.recvmsg_into([buf], OVFL_CMSG_SPACE)
+                for level, kind, data in ancdata:
+                    if level == socket.SOL_SOCKET and kind == SO_RXQ_OVFL:
+                        self.drops[s] = struct.unpack('=I', data[:4])[0]
+            else:
+                nbytes, address = s.recvfrom_into(buf)
+            if address not in self.ignore:
+                return nbytes, address
+
+    # read all queued datagrams of a socket, up to
+    # the available room in the ring
+    def __drain(self, s):
+        ring = self.ring
+        slots = len(ring)
+        while len(self.pending) < slots:
+            buf = ring[self.next_slot]
+            try:
+                nbytes, address = self.recv_into(s, buf)
+            except BlockingIOError:
+                return
+            self.next_slot = (self.next_slot + 1) % slots
+            self.pending.append((buf[:nbytes], address, s))
+
+    # wait up to timeout seconds for a packet
+    #
+    # return tuple
+    #   (data, address, sock)
+    # or (None, None, None) on timeout
+    def receive(self, timeout=1.0):
+        if not self.pending:
+            ready, _, _ = select.select(self.sock_list, [], [], timeout)
+            for s in ready:
+                self.__drain(s)
+        if self.pending:
+            return self.pending.popleft()
+        return (None, None, None)
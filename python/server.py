@@ -1,18 +1,24 @@
 #!/bin/python3
 
-from conf import analyse_args, CLIENT_BROADCAST, CLIENT_PORT, MAX_PACKET_SIZE
+from conf import analyse_args, CLIENT_BROADCAST, CLIENT_PORT
+import conf
 import socket
-import select
 import sys
 import os.path
 import ipaddress
+import collections
+import random
+import time
 
 import getopt
 
 
+import rxring
 import smfsp
 
 verbose = False
+# swarm mode: leave clients the chance to answer requests
+swarm = False
 
 sock = socket.socket(
     socket.AF_INET,
@@ -22,6 +28,25 @@ broad_sock = socket.socket(
     socket.AF_INET,
     socket.SOCK_DGRAM | socket.SOCK_NONBLOCK)
 sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+# in swarm mode, peers listen on the server port too
+broad_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+# swarm mode only: overhear chunks sent by peers
+overhear_sock = socket.socket(
+    socket.AF_INET,
+    socket.SOCK_DGRAM | socket.SOCK_NONBLOCK)
+overhear_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+# same as above for messages in smfsp.EXT_TYPES
+ext_sock = socket.socket(
+    socket.AF_INET,
+    socket.SOCK_DGRAM | socket.SOCK_NONBLOCK)
+ext_broad_sock = socket.socket(
+    socket.AF_INET,
+    socket.SOCK_DGRAM | socket.SOCK_NONBLOCK)
+ext_broad_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+overhear_ext_sock = socket.socket(
+    socket.AF_INET,
+    socket.SOCK_DGRAM | socket.SOCK_NONBLOCK)
+overhear_ext_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
 
 broadcast_client = ('255.255.255.255', CLIENT_PORT)
 
@@ -43,122 +68,248 @@ def check_file_existence(fmaps):
         if not os.path.exists(path):
             raise Exception("File '" + path + "' not found")
         tmp = {
+            'id': len(ans),
             'name': name,
             'path': path,
-            'size': os.path.getsize(path)
+            'size': os.path.getsize(path),
+            'version': 0,
+            # chunk size of CNK_OFFER_ID
+            'cnk_size': conf.COMPACT_CHUNK_SIZE,
         }
         ans[name] = tmp
     return ans
 
+# find metadata of the file a packet refers to, by
+# id or by name, None if unknown or changed
+def find_file(fmap, flist, content):
+    if 'id' in content:
+        if content['id'] >= len(flist):
+            return None
+        fmeta = flist[content['id']]
+        if content['version'] != fmeta['version'] % 2**32:
+            return None
+    else:
+        fmeta = fmap.get(content['name'])
+        if fmeta is None or content['size'] != fmeta['size']:
+            return None
+    return fmeta
+
+# chunk size used to send a file with CNK_OFFER of the
+# given kind
+def chunk_size(fmeta, offer_type):
+    if offer_type == smfsp.CNK_OFFER_ID:
+        return fmeta['cnk_size']
+    return conf.DEFAULT_CHUNK_SIZE
+
 def print_file_map(fmaps):
     for k,v in fmaps.items():
         print('\t', k, '=>', v)
 
-def receive_from(sock_list, timeout=1.0, bufsz = MAX_PACKET_SIZE):
-    s, _, _ = select.select(sock_list, [], [], timeout)
-    for sock in s:
-        if verbose:
-            print(f"Reading data from sock: {sock.getsockname()}")
-        bytes, address = sock.recvfrom(bufsz)
-        return (bytes, address, sock)
-    return (None, None, None)
-    #raise Exception("Timeout!")
-
 
 # the server periodically send server hello or, if
 # a client hello is received, sent a server hello
-# immediately
-def server_loop(socket_list, fmap, timeout=1.0, broadcast_addr = '255.255.255.255', client_port=CLIENT_PORT):
+# after a short random delay.
+#
+# Hello traffic is bounded: replies to all client hellos
+# received in the meanwhile are coalesced in a single
+# broadcast (plus a unicast copy for the few clients not
+# listening on client_port), two hellos are never closer
+# than HELLO_MIN_GAP and, while clients keep the server busy
+# with hellos and requests, the periodic interval doubles
+# up to HELLO_MAX_INTERVAL. It shrinks back when the load
+# goes down and it is reset when the catalog changes.
+#
+# In swarm mode every chunk is sent only after ORIGIN_DEFER
+# seconds and it is not sent at all if in the meanwhile
+# a peer has been overheard sending it
+def server_loop(socket_list, fmap, timeout=conf.HELLO_MIN_INTERVAL, broadcast_addr = '255.255.255.255', client_port=CLIENT_PORT):
     clients = (broadcast_addr, client_port)
-    if verbose:
-        print("Broadcast server hello packet")
-    smfsp.send_server_hello(sock, clients, fmap)
+    # files indexed by id
+    flist = sorted(fmap.values(), key=lambda fmeta: fmeta['id'])
+    # state of hello scheduling
+    hello = {
+        'packet': None,     # last SRV_HELLO_IDs sent
+        'interval': timeout,
+        'last': 0.0,        # when last hello was sent
+        'next': 0.0,        # next periodic hello
+        'reply': None,      # pending reply to client hellos
+        'unicast': set(),   # clients to reply to directly
+        'events': 0,        # hellos and requests received...
+        'since': 0.0,       # ...since this periodic hello
+    }
+    def broadcast_hello(now, periodic=False):
+        if verbose:
+            print("Broadcast server hello packet")
+        packets = smfsp.build_server_hello_by_id(flist)
+        if packets is not hello['packet']:
+            # catalog changed, let clients know soon
+            hello['interval'] = timeout
+            hello['packet'] = packets
+        elif periodic:
+            # slow down while busy, speed up when idle
+            rate = hello['events'] / max(now - hello['since'], timeout)
+            if rate > conf.HELLO_BUSY_RATE:
+                hello['interval'] = min(hello['interval']*2, conf.HELLO_MAX_INTERVAL)
+            else:
+                hello['interval'] = max(hello['interval']/2, timeout)
+            if verbose:
+                print(f"Load {rate:.1f} packets/s, hello interval {hello['interval']}")
+        if periodic:
+            hello['events'] = 0
+            hello['since'] = now
+        for packet in packets:
+            sock.sendto(packet, smfsp.destination(smfsp.SRV_HELLO_ID, clients, conf.CLIENT_EXT_PORT))
+        if conf.LEGACY_HELLO:
+            legacy = [smfsp.build_server_hello(fmap)]
+            sock.sendto(legacy[0], clients)
+        # whether a client is old or new cannot be known,
+        # an old one would die on SRV_HELLO_ID
+        for dest in hello['unicast']:
+            for packet in (legacy if conf.LEGACY_HELLO else packets):
+                sock.sendto(packet, dest)
+        hello['unicast'].clear()
+        hello['last'] = now
+        hello['next'] = now + hello['interval']
+        hello['reply'] = None
+    broadcast_hello(time.monotonic(), periodic=True)
     # has the server some work to complete?
     pendig_work = False
     # list of requested chunks
-    req_chunks = []
-    # control structure to avoid sending twice the same chunk
+    req_chunks = collections.deque()
+    # control structure to avoid sending twice the same chunk,
+    # map (chunk index, offer type) to work item
     waiting_chunks = {}
     for file in fmap:
-        waiting_chunks[file] = set()
+        waiting_chunks[file] = {}
+    # delay applied before sending chunks
+    defer = conf.ORIGIN_DEFER if swarm else 0.0
     # send no more than PACKETS_PER_ITERATION packets
     # before checking for ner inputs
     MAX_PACKETS_PER_ITERATION=4
+    # drain sockets in batches, packets sent by this
+    # server are overheard too: drop them immediately
+    receiver = rxring.Receiver(socket_list, ignore=[rxring.source_address(sock, clients)])
+    if verbose:
+        print("Socket receive buffers:", list(receiver.rcvbuf.values()))
     while True:
+        # handle work
+        sent = 0
+        now = time.monotonic()
+        # in swarm mode, handle overheard packets first:
+        # they may be peer offers cancelling some work
+        while len(req_chunks) > 0 and sent < MAX_PACKETS_PER_ITERATION \
+                and req_chunks[0]['due'] <= now \
+                and not (swarm and receiver.pending):
+            w = req_chunks.popleft()
+            if w['cancelled']:
+                # a peer has already sent it
+                continue
+            # remove chunk from control list
+            del waiting_chunks[w['file']][(w['cnk_idx'], w['offer_type'])]
+            if verbose:
+                print(f"Sending chunk {w['cnk_idx']} of file {w['file']}")
+            dest = smfsp.destination(w['offer_type'], broadcast_client, conf.CLIENT_EXT_PORT)
+            smfsp.send_chunk(sock, dest, fmap, w['file'], w['cnk_idx'], w['cnk_sz'], codecs=w['codecs'], offer_type=w['offer_type'])
+            sent += 1
+        pendig_work = len(req_chunks) > 0
+
+        now = time.monotonic()
+        if hello['reply'] is not None and now >= hello['reply']:
+            if verbose:
+                print("Send server_hello in response to client hellos")
+            broadcast_hello(now)
+        elif not pendig_work and now >= hello['next']:
+            # periodic hello, but only if no work is pending!
+            if verbose:
+                print("Packets dropped by the kernel:", receiver.dropped())
+                print("Datagram cache:", smfsp.datagram_cache.stats())
+            broadcast_hello(now, periodic=True)
+        deadline = hello['next'] if hello['reply'] is None else min(hello['next'], hello['reply'])
         if pendig_work:
-            # handle work
-            for _ in range(MAX_PACKETS_PER_ITERATION):
-                if len(req_chunks) <= 1:
-                    # no more works after this
-                    pendig_work = False
-                    if len(req_chunks) == 0:
-                        break
-                w = req_chunks.pop(0)
-                # remove chunk from control list
-                waiting_chunks[w['file']].remove(w['cnk_idx'])
-                if verbose:
-                    print(f"Sending chunk {w['cnk_idx']} of file {w['file']}")
-                smfsp.send_chunk(sock, broadcast_client, fmap, w['file'], w['cnk_idx'])
-                # after having sent the last chunk?
+            # wait for the first deferred chunk
+            deadline = min(deadline, req_chunks[0]['due'])
 
-        bytes, sender, _ = receive_from(socket_list,
-                                # cannot wait if something is waiting!
-                                timeout=None if pendig_work else timeout)
+        bytes, sender, _ = receiver.receive(
+                                timeout=max(0, deadline - now))
         if bytes != None:
             # parse message
-            msg_type, content = smfsp.parse_packet(bytes)
+            try:
+                msg_type, content = smfsp.parse_packet(bytes)
+            except Exception as e:
+                # malformed or unknown packet, drop it
+                if verbose:
+                    print(f"Dropped packet from {sender}: {e}")
+                continue
             print('\tType:', smfsp.type2name(msg_type))
             print('\tData:', content)
             print()
+            if msg_type == smfsp.CLN_HELLO or msg_type in smfsp.OFFER_FOR_REQ:
+                hello['events'] += 1
             if msg_type == smfsp.CLN_HELLO:
-                if verbose:
-                    print("Send server_hello in response to client hello")
-                smfsp.send_server_hello(sock, sender, fmap)
-            elif msg_type == smfsp.CNK_LIST_REQ:
-                # check file is owned
-                if content['name'] not in fmap:
+                # the broadcast does not reach clients
+                # listening on other ports
+                if sender[1] != client_port and len(hello['unicast']) < conf.HELLO_MAX_UNICAST:
+                    hello['unicast'].add(sender)
+                # schedule a reply, if not already done
+                if hello['reply'] is None:
+                    hello['reply'] = max(time.monotonic() + random.uniform(0, conf.HELLO_REPLY_DELAY),
+                        hello['last'] + conf.HELLO_MIN_GAP)
                     if verbose:
-                        print(f"Unknown file {content['name']}")
-                    # nothing to do, go on
-                    continue
-                # get file info
-                fmeta = fmap[content['name']]
-                # check on file size
-                if content['size'] != fmeta['size']:
-                    # size mismatch!
+                        print("Schedule server_hello in response to client hello")
+            elif msg_type in smfsp.OFFER_FOR_REQ:
+                # answer in the same format
+                offer_type = smfsp.OFFER_FOR_REQ[msg_type]
+                # check file is owned and unchanged
+                fmeta = find_file(fmap, flist, content)
+                if fmeta is None:
                     if verbose:
-                        print(f"Mismatch in file [{content['name']}] size: {content['size']} instead of {fmeta['size']}")
+                        print(f"Unknown or changed file: {content}")
                     # nothing to do, go on
                     continue
+                name = fmeta['name']
+                cnk_sz = chunk_size(fmeta, offer_type)
                 # send, one by one, all required chunks
+                queued = []
                 for cnk_idx in content['cnk_list']:
                     # do not send the same chunk twice
-                    if not cnk_idx in waiting_chunks[content['name']]:
-                        waiting_chunks[content['name']].add(cnk_idx)
+                    if not (cnk_idx, offer_type) in waiting_chunks[name]:
                         w = {
-                            'file': content['name'],
+                            'file': name,
                             'cnk_idx': cnk_idx,
+                            'codecs': content['codecs'],
+                            'offer_type': offer_type,
+                            'cnk_sz': cnk_sz,
+                            'due': time.monotonic() + defer,
+                            'cancelled': False,
                         }
+                        waiting_chunks[name][(cnk_idx, offer_type)] = w
                         req_chunks.append(w)
+                        queued.append(cnk_idx)
                         if verbose:
                             print("Register work:", w)
                         pendig_work = True
-
-        # Timeout! Send server hello!
-        elif not pendig_work:
-            # but only if no work is pending!
-            if verbose:
-                print("Broadcast server hello packet")
-            smfsp.send_server_hello(sock, clients, fmap)
-
+                # prefetch chunks not sent yet
+                smfsp.advise_chunks(fmeta, queued, cnk_sz)
+            elif msg_type in smfsp.OFFER_FOR_REQ.values() and swarm:
+                # a peer answered, do not send the same chunk
+                fmeta = find_file(fmap, flist, content)
+                if fmeta is not None:
+                    cnk_idx = content['cnk_offset'] // chunk_size(fmeta, msg_type)
+                    w = waiting_chunks[fmeta['name']].pop((cnk_idx, msg_type), None)
+                    if w is not None:
+                        w['cancelled'] = True
+                        if verbose:
+                            print(f"Chunk {cnk_idx} of file {fmeta['name']} sent by peer {sender}")
 
 def main():
     global verbose
+    global swarm
     # parse options
-    optlist, args = getopt.gnu_getopt(sys.argv[1:], 'p:i:v')
+    optlist, args = getopt.gnu_getopt(sys.argv[1:], 'p:i:vs')
     # parse arguments
     opts = analyse_args(optlist, isserver=True)
     verbose = opts["verbose"]
+    swarm = opts["swarm"]
 
     # map of file paths
     pmap = getFileMap(args)
@@ -177,14 +328,22 @@ def main():
     if verbose:
         print("Try to bind broadcast socket")
     broad_sock.bind(('<broadcast>', opts['bind_port']))
+    if verbose:
+        print("Try to bind extension sockets")
+    ext_sock.bind((opts['bind_addr'], conf.SERVER_EXT_PORT))
+    ext_broad_sock.bind(('<broadcast>', conf.SERVER_EXT_PORT))
+    socket_list = [sock, broad_sock, ext_sock, ext_broad_sock]
+    if swarm:
+        if verbose:
+            print("Try to bind sockets to overhear peers")
+        overhear_sock.bind(('<broadcast>', CLIENT_PORT))
+        overhear_ext_sock.bind(('<broadcast>', conf.CLIENT_EXT_PORT))
+        socket_list += [overhear_sock, overhear_ext_sock]
     if verbose:
         print("All sockets bound!")
 
-    test_client = ('255.255.255.255', CLIENT_PORT)
     # main loop - send hello packets
-    smfsp.send_server_hello(sock, test_client, fmap)
-
-    server_loop([sock, broad_sock], fmap)
+    server_loop(socket_list, fmap)
 
 if __name__ == "__main__":
     main()
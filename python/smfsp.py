@@ -1,6 +1,9 @@
 
+import collections
 import hashlib
+import lzma
 import os
+import zlib
 
 import conf
 
@@ -37,6 +40,26 @@ def serialize_fname_sz_seq(fmap):
         buf += serialize_short_str(name) + i2b(info['size'], limit=8)
     return buf
 
+# serialize the file list of a SRV_HELLO_ID, for every file:
+#   file id     [short]
+#   version     [int]
+#   size        [long]
+#   chunk size  [int], used by CNK_OFFER_ID
+#   name        [short string]
+def serialize_file_id_seq(flist):
+    l = len(flist)
+    if not 0 < l < 65536:
+        raise Exception("File count", l, "outside validity range (0,65536)")
+    return i2b(l, limit=2) + b''.join(map(serialize_file_id, flist))
+
+# serialize a single file of a SRV_HELLO_ID file list
+def serialize_file_id(info):
+    return i2b(info['id'], limit=2) +\
+        i2b(info.get('version', 0) % 2**32, limit=4) +\
+        i2b(info['size'], limit=8) +\
+        i2b(info.get('cnk_size', conf.COMPACT_CHUNK_SIZE), limit=4) +\
+        serialize_short_str(info['name'])
+
 
 # Extract payload content from SERVER_HELLO
 # offset: used to avoid generating new byte buffers
@@ -60,41 +83,65 @@ def __extract_file_data(b, offset=0):
         # ensure there is enough space for file name and length
         if len(b) - offset < strlen + 8:
             raise Exception("Malformed buffer")
-        ans[b[offset:offset+strlen].decode()] = b2i(b[offset+strlen:offset+strlen+8])
+        ans[str(b[offset:offset+strlen], 'utf-8')] = b2i(b[offset+strlen:offset+strlen+8])
         offset += strlen + 8
     return (ans, offset)
 
-# used to parse body of CNK_OFFER
-def __extract_chunk(b, offset=0):
+# Extract payload content from SRV_HELLO_ID
+# return tuple
+#   (list of dict{'id', 'version', 'size', 'name'}, final_offset)
+def __extract_file_data_by_id(b, offset=0):
+    # get items count
+    if len(b) - offset < 2:
+        raise Exception("Malformed buffer - missing length")
+    scount = b2i(b[offset:offset+2])
+    offset += 2
+    ans = []
+    # for all listed files
+    for _ in range(scount):
+        # ensure id, version, size, chunk size and
+        # name length available
+        if len(b) - offset < 19:
+            raise Exception("Malformed buffer")
+        file_id = b2i(b[offset:offset+2])
+        version = b2i(b[offset+2:offset+6])
+        size = b2i(b[offset+6:offset+14])
+        cnk_size = b2i(b[offset+14:offset+18])
+        strlen = b2i(b[offset+18:offset+19])
+        offset += 19
+        if cnk_size == 0:
+            raise Exception("Malformed buffer - null chunk size")
+        if len(b) - offset < strlen:
+            raise Exception("Malformed buffer")
+        ans.append({
+            'id': file_id,
+            'version': version,
+            'size': size,
+            'cnk_size': cnk_size,
+            'name': str(b[offset:offset+strlen], 'utf-8'),
+        })
+        offset += strlen
+    return (ans, offset)
+
+# used to parse the part of CNK_OFFER, CNK_OFFER_CODEC
+# and CNK_OFFER_ID following file identification
+#   encoded: are codec and payload length present?
+def __extract_chunk_body(b, offset=0, encoded=True):
     buflen = len(b)
     # expected structure:
-    #   name of the file  [short string]
-    #   total file size   [long]
     #   chunk offset      [long]
     #   chunk size        [long]
     #   last chunk        [byte]
-    # name is variable length, other part
-    # has fixed size of 25 bytes
-    HEADERLEN = 25
+    # if encoded:
+    #   codec             [byte]
+    #   payload length    [int]
+    # fixed size of 22 bytes (17 if not encoded)
+    HEADERLEN = 22 if encoded else 17
 
-    # EXTRACT FILENAME
-    if buflen - offset < 1:
-        raise Exception("Malformed buffer - missing filename length")
-    strlen = b2i(b[offset:offset+1])
-    offset += 1
-    # ensure there is enough space for file name and length
-    if buflen - offset < strlen:
-        raise Exception("Malformed buffer - missing filename")
-    filename = b[offset:offset+strlen].decode()
-    offset += strlen
-
-    # are all 25 bytes present?
+    # are all header bytes present?
     if buflen - offset < HEADERLEN:
         raise Exception("Malformed buffer - missing header")
 
-    # get total file size    
-    size = b2i(b[offset:offset+8])
-    offset += 8
     # get chunk offset
     cnk_offset = b2i(b[offset:offset+8])
     offset += 8
@@ -104,25 +151,38 @@ def __extract_chunk(b, offset=0):
     # last chunk?
     last_cnk = b2i(b[offset:offset+1]) != 0
     offset += 1
+    if encoded:
+        # payload encoding
+        codec = b2i(b[offset:offset+1])
+        offset += 1
+        # length of the (encoded) payload
+        payload_len = b2i(b[offset:offset+4])
+        offset += 4
+    else:
+        codec = CODEC_RAW
+        payload_len = cnk_size
 
     # check payload presence?
-    if buflen - offset < cnk_size:
+    if buflen - offset < payload_len:
         raise Exception("Malformed buffer - missing chunk content")
-    data = b[offset:offset+cnk_size]
-    offset += cnk_size
+    data = decode_chunk(codec, b[offset:offset+payload_len], cnk_size)
+    offset += payload_len
 
     return ({
-        'name': filename,
-        'size': size,
         'cnk_offset': cnk_offset,
         'cnk_size': cnk_size,
         'last_cnk': last_cnk,
+        'codec': codec,
         'data': data
     }, offset)
 
-
-def __extract_chunk_list_req(b, offset=0):
+# used to parse body of CNK_OFFER and CNK_OFFER_CODEC
+def __extract_chunk(b, offset=0, encoded=True):
     buflen = len(b)
+    # expected structure:
+    #   name of the file  [short string]
+    #   total file size   [long]
+    #   chunk body (see __extract_chunk_body)
 
     # EXTRACT FILENAME
     if buflen - offset < 1:
@@ -132,16 +192,57 @@ def __extract_chunk_list_req(b, offset=0):
     # ensure there is enough space for file name and length
     if buflen - offset < strlen:
         raise Exception("Malformed buffer - missing filename")
-    filename = b[offset:offset+strlen].decode()
+    filename = str(b[offset:offset+strlen], 'utf-8')
     offset += strlen
 
-    # are file size and list length present?
-    if buflen - offset < 12: # [long + int]
+    # is file size present?
+    if buflen - offset < 8:
         raise Exception("Malformed buffer - missing header")
 
     # get total file size    
     size = b2i(b[offset:offset+8])
     offset += 8
+
+    ans, offset = __extract_chunk_body(b, offset, encoded)
+    ans['name'] = filename
+    ans['size'] = size
+    return (ans, offset)
+
+# used to parse body of CNK_OFFER_ID
+def __extract_chunk_by_id(b, offset=0):
+    # expected structure:
+    #   file id           [short]
+    #   file version      [int]
+    #   chunk body (see __extract_chunk_body)
+    if len(b) - offset < 6:
+        raise Exception("Malformed buffer - missing file id")
+    file_id = b2i(b[offset:offset+2])
+    version = b2i(b[offset+2:offset+6])
+    offset += 6
+
+    ans, offset = __extract_chunk_body(b, offset)
+    ans['id'] = file_id
+    ans['version'] = version
+    return (ans, offset)
+
+
+# used to parse the part of CNK_LIST_REQ, CNK_LIST_REQ_CODEC
+# and CNK_LIST_REQ_ID following file identification
+#   encoded: is the codecs bitmask present?
+def __extract_chunk_list(b, offset=0, encoded=True):
+    buflen = len(b)
+
+    # are codecs and list length present?
+    if buflen - offset < (5 if encoded else 4): # [byte +] int
+        raise Exception("Malformed buffer - missing header")
+
+    if encoded:
+        # codecs supported by the client
+        codecs = b2i(b[offset:offset+1])
+        offset += 1
+    else:
+        # old clients only know raw chunks
+        codecs = codec_mask([CODEC_RAW])
     # get chunk offset
     cnk_list_len = b2i(b[offset:offset+4])
     offset += 4
@@ -156,11 +257,49 @@ def __extract_chunk_list_req(b, offset=0):
         offset += 8
 
     return ({
-        'name': filename,
-        'size': size,
+        'codecs': codecs,
         'cnk_list': cnk_list,
     }, offset)
 
+def __extract_chunk_list_req(b, offset=0, encoded=True):
+    buflen = len(b)
+
+    # EXTRACT FILENAME
+    if buflen - offset < 1:
+        raise Exception("Malformed buffer - missing filename length")
+    strlen = b2i(b[offset:offset+1])
+    offset += 1
+    # ensure there is enough space for file name and length
+    if buflen - offset < strlen:
+        raise Exception("Malformed buffer - missing filename")
+    filename = str(b[offset:offset+strlen], 'utf-8')
+    offset += strlen
+
+    # is file size present?
+    if buflen - offset < 8:
+        raise Exception("Malformed buffer - missing header")
+
+    # get total file size    
+    size = b2i(b[offset:offset+8])
+    offset += 8
+
+    ans, offset = __extract_chunk_list(b, offset, encoded)
+    ans['name'] = filename
+    ans['size'] = size
+    return (ans, offset)
+
+def __extract_chunk_list_req_by_id(b, offset=0):
+    if len(b) - offset < 6: # [short + int]
+        raise Exception("Malformed buffer - missing file id")
+    file_id = b2i(b[offset:offset+2])
+    version = b2i(b[offset+2:offset+6])
+    offset += 6
+
+    ans, offset = __extract_chunk_list(b, offset)
+    ans['id'] = file_id
+    ans['version'] = version
+    return (ans, offset)
+
 
 # check packet checksum
 #   buffer  =>  packet content in byte
@@ -219,6 +358,52 @@ CLN_HELLO = b'CHLO'[:TYPE_LENGTH] # sent by a client
 #       a [long] containing the chunk id
 CNK_LIST_REQ = b'CLST'[:TYPE_LENGTH] # sent by a client
 
+# Variants supporting compressed chunks: CNK_LIST_REQ_CODEC
+# adds, after the requested file size, the codecs supported
+# by the client [byte, bitmask of codec_mask()].
+# CNK_OFFER_CODEC adds, after the last chunk flag, the codec
+# used [byte] and the payload length [int].
+# A server answers with the same family of the request, so
+# old clients keep receiving raw CNK_OFFER. Both are sent to
+# the extension ports only, see EXT_TYPES.
+CNK_OFFER_CODEC = b'OFRC'[:TYPE_LENGTH] # sent by a server
+CNK_LIST_REQ_CODEC = b'CLSC'[:TYPE_LENGTH] # sent by a client
+
+# Compact variants: SRV_HELLO_ID assigns each file a numeric
+# id [short], valid together with the file version [int],
+# and the chunk size [int] of its compact transfers.
+# CNK_OFFER_ID and CNK_LIST_REQ_ID carry only id and
+# version in place of file name and size, leaving more
+# room for payload, and support codecs like the _CODEC
+# variants. They are sent to the extension ports only,
+# see EXT_TYPES.
+# Old messages are still accepted.
+SRV_HELLO_ID = b'SHLI'[:TYPE_LENGTH] # sent by a server
+CNK_OFFER_ID = b'OFRI'[:TYPE_LENGTH] # sent by a server
+CNK_LIST_REQ_ID = b'CLSI'[:TYPE_LENGTH] # sent by a client
+
+# kind of CNK_OFFER answering each kind of request
+OFFER_FOR_REQ = {
+    CNK_LIST_REQ: CNK_OFFER,
+    CNK_LIST_REQ_CODEC: CNK_OFFER_CODEC,
+    CNK_LIST_REQ_ID: CNK_OFFER_ID,
+}
+
+# messages old clients and servers do not understand: an
+# unknown packet type kills them, so these messages are
+# sent to conf.SERVER_EXT_PORT and conf.CLIENT_EXT_PORT only
+EXT_TYPES = {
+    CNK_OFFER_CODEC, CNK_LIST_REQ_CODEC,
+    SRV_HELLO_ID, CNK_OFFER_ID, CNK_LIST_REQ_ID,
+}
+
+# where to send a message of the given type, instead of
+# address: messages in EXT_TYPES go to ext_port
+def destination(msg_type, address, ext_port):
+    if msg_type in EXT_TYPES:
+        return (address[0], ext_port)
+    return address
+
 def type2name(pckt_type):
     if pckt_type == SRV_HELLO:
         return "SRV_HELLO"
@@ -228,9 +413,90 @@ def type2name(pckt_type):
         return "CNK_OFFER"
     if pckt_type == CNK_LIST_REQ:
         return "CNK_LIST_REQ"
+    if pckt_type == CNK_OFFER_CODEC:
+        return "CNK_OFFER_CODEC"
+    if pckt_type == CNK_LIST_REQ_CODEC:
+        return "CNK_LIST_REQ_CODEC"
+    if pckt_type == SRV_HELLO_ID:
+        return "SRV_HELLO_ID"
+    if pckt_type == CNK_OFFER_ID:
+        return "CNK_OFFER_ID"
+    if pckt_type == CNK_LIST_REQ_ID:
+        return "CNK_LIST_REQ_ID"
     else:
         raise Exception("Unknown packet type")
 
+# CHUNK CODECS
+# Encoding applied to the payload of a CNK_OFFER.
+# A client advertises the codecs it is able to decode
+# in every CNK_LIST_REQ, RAW is always supported.
+CODEC_RAW  = 0
+CODEC_ZLIB = 1
+CODEC_LZMA = 2
+# chunk made only of zero bytes, no payload is sent
+CODEC_ZERO = 3
+
+# codecs the server tries, in order of preference,
+# before falling back to CODEC_RAW
+CODEC_PREFERENCE = [CODEC_ZERO, CODEC_ZLIB, CODEC_LZMA]
+
+# bitmask used to advertise a set of codecs
+def codec_mask(codecs):
+    mask = 0
+    for c in codecs:
+        mask |= 1 << c
+    return mask
+
+# codecs supported by this implementation
+SUPPORTED_CODECS = codec_mask([CODEC_RAW, CODEC_ZLIB, CODEC_LZMA, CODEC_ZERO])
+
+# decode the payload of a CNK_OFFER
+#   codec:      codec used to encode the payload
+#   payload:    encoded chunk content
+#   cnk_size:   expected size of the decoded chunk
+def decode_chunk(codec, payload, cnk_size):
+    if cnk_size > conf.MAX_DECODED_CHUNK_SIZE:
+        raise Exception("Malformed buffer - chunk too big: " + str(cnk_size))
+    if codec == CODEC_RAW:
+        data = payload
+    elif codec == CODEC_ZERO:
+        data = bytes(cnk_size)
+    elif codec == CODEC_ZLIB:
+        # bound output size to avoid decompression bombs
+        data = zlib.decompressobj().decompress(payload, cnk_size)
+    elif codec == CODEC_LZMA:
+        data = lzma.LZMADecompressor().decompress(payload, max_length=cnk_size)
+    else:
+        raise Exception("Unknown codec: " + str(codec))
+    if len(data) != cnk_size:
+        raise Exception("Malformed buffer - chunk size mismatch after decoding")
+    return data
+
+# encode a chunk content using the first codec
+# in CODEC_PREFERENCE accepted by the client
+# that actually reduces the chunk size
+#
+# return tuple
+#   (codec, payload)
+def encode_chunk(data, codecs=SUPPORTED_CODECS):
+    for codec in CODEC_PREFERENCE:
+        if not codecs & (1 << codec):
+            continue
+        if codec == CODEC_ZERO:
+            if data.count(0) == len(data):
+                return (CODEC_ZERO, b'')
+            continue
+        if codec == CODEC_ZLIB:
+            payload = zlib.compress(data, conf.ZLIB_LEVEL)
+        elif codec == CODEC_LZMA:
+            payload = lzma.compress(data, preset=conf.LZMA_PRESET)
+        if len(payload) < len(data):
+            return (codec, payload)
+        # a codec that cannot shrink this chunk will not
+        # shrink it with the others, send it as it is
+        break
+    return (CODEC_RAW, data)
+
 # PAYLOAD
 #   8 byte length - +4GB allowed
 #   data...
@@ -245,15 +511,116 @@ HASH_SHA256 = i2b(256,  limit=HASH_LENGTH)
 #   hash of the previous message calculated
 #   accordingly to the specified hash type
 
-# hash and send packet
-def __hash_and_send(s, dest_address, msg, hash_type=HASH_SHA256):
+# append trailing hash to a packet
+def __hash(msg, hash_type=HASH_SHA256):
     if hash_type == HASH_NONE:
-        buff = msg+HASH_NONE
+        return msg+HASH_NONE
     elif hash_type == HASH_SHA256:
-        buff = msg+HASH_SHA256+hashlib.sha256(msg).digest()
+        return msg+HASH_SHA256+hashlib.sha256(msg).digest()
     else:
         raise Exception()
-    s.sendto(buff, dest_address)
+
+# hash and send packet
+def __hash_and_send(s, dest_address, msg, hash_type=HASH_SHA256):
+    s.sendto(__hash(msg, hash_type), dest_address)
+
+# Bounded LRU cache of fully encoded and hashed
+# CNK_OFFER datagrams, sized in bytes.
+#
+# Keys begin with the file name so all the datagrams
+# of a file can be dropped when it changes.
+class DatagramCache:
+    def __init__(self, max_bytes=conf.DATAGRAM_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.entries = collections.OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        datagram = self.entries.get(key)
+        if datagram is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self.entries.move_to_end(key)
+        return datagram
+
+    def put(self, key, datagram):
+        if len(datagram) > self.max_bytes:
+            return
+        old = self.entries.pop(key, None)
+        if old is not None:
+            self.size -= len(old)
+        self.entries[key] = datagram
+        self.size += len(datagram)
+        while self.size > self.max_bytes:
+            _, evicted = self.entries.popitem(last=False)
+            self.size -= len(evicted)
+            self.evictions += 1
+
+    # drop all datagrams of a file
+    def invalidate(self, filename):
+        for key in [k for k in self.entries if k[0] == filename]:
+            self.size -= len(self.entries.pop(key))
+
+    def stats(self):
+        return {
+            'entries': len(self.entries),
+            'bytes': self.size,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+        }
+
+# datagrams sent by send_chunk
+datagram_cache = DatagramCache()
+
+# Check if a file changed since last time, if so
+# bump its version and drop all cached data
+#
+# return current file size
+def refresh_file_version(fmeta):
+    st = os.stat(fmeta['path'])
+    if st.st_size != fmeta['size'] or st.st_mtime_ns != fmeta.setdefault('mtime', st.st_mtime_ns):
+        # update last size
+        fmeta['size'] = st.st_size
+        fmeta['mtime'] = st.st_mtime_ns
+        fmeta['version'] = fmeta.get('version', 0) + 1
+        # cached chunks are no more valid
+        datagram_cache.invalidate(fmeta['name'])
+        fmeta.pop('raw_chunks', None)
+    return st.st_size
+
+# Bitset of the chunks of a file that no codec can shrink,
+# one per chunk size in use, valid for the current version
+# of the file. Such chunks are not compressed again on
+# every datagram_cache miss, whatever codecs are asked.
+def __raw_chunks(fmeta, cnk_sz):
+    nchunks = (fmeta['size'] + cnk_sz - 1) // cnk_sz
+    return fmeta.setdefault('raw_chunks', {}).setdefault(cnk_sz,
+        bytearray((nchunks + 7) // 8))
+
+# Hint the kernel about chunks that are going to be sent.
+# Clients request sorted lists of random chunks, so runs
+# of adjacent chunks are prefetched with a single call.
+def advise_chunks(fmeta, cnk_list, cnk_sz=conf.DEFAULT_CHUNK_SIZE):
+    if not conf.FADVISE_WILLNEED or not hasattr(os, 'posix_fadvise'):
+        return
+    fd = os.open(fmeta['path'], os.O_RDONLY)
+    try:
+        start = prev = None
+        for cnk_num in sorted(cnk_list) + [None]:
+            if start is not None and cnk_num != prev + 1:
+                os.posix_fadvise(fd, start*cnk_sz, (prev-start+1)*cnk_sz,
+                    os.POSIX_FADV_WILLNEED)
+                start = None
+            if start is None:
+                start = cnk_num
+            prev = cnk_num
+    finally:
+        os.close(fd)
 
 # Send a CNK_OFFER packet
 #
@@ -263,79 +630,209 @@ def __hash_and_send(s, dest_address, msg, hash_type=HASH_SHA256):
 # reqfile:  from which file has to be sent  [short string]
 # cnk_num:  which chunk should be sent?     [long]
 # cnk_sz:   chunk size                      [long]
+# codecs:   codecs supported by the client  [byte]
+# offer_type: CNK_OFFER, CNK_OFFER_CODEC or CNK_OFFER_ID,
+#           see OFFER_FOR_REQ
 #
 # Files are sent in chunks aligned to chunk size
 #   chunk offset => cnk_num*cnk_sz   
-def send_chunk(s, dest_addr, fmap, reqfile, cnk_num, cnk_sz=conf.DEFAULT_CHUNK_SIZE, hash_type=HASH_SHA256):
+#
+# Whole datagrams are kept in datagram_cache so hot chunks
+# are read and compressed only once, chunks that do not
+# shrink are remembered in fmeta['raw_chunks']. Both are
+# dropped whenever the file changes.
+def send_chunk(s, dest_addr, fmap, reqfile, cnk_num, cnk_sz=conf.DEFAULT_CHUNK_SIZE, hash_type=HASH_SHA256, codecs=SUPPORTED_CODECS, offer_type=CNK_OFFER_CODEC):
+    # old CNK_OFFER cannot carry encoded chunks
+    if offer_type == CNK_OFFER:
+        codecs = codec_mask([CODEC_RAW])
     # offset of the chunk to be sent
     cnk_offset = cnk_num*cnk_sz
     # metadata associated to the file
     fmeta = fmap[reqfile]
     # path of the file to be sent
     filename = fmeta['path']
-    # check on file size (to detect changes)
-    size = os.path.getsize(filename)
-    if size != fmeta['size']:
-        # update last size
-        fmeta['size'] = size
+    # check on file size and time (to detect changes)
+    size = refresh_file_version(fmeta)
+
+    # hot chunk?
+    dkey = (reqfile, cnk_num, fmeta.get('version', 0), cnk_sz, codecs, hash_type, offer_type)
+    datagram = datagram_cache.get(dkey)
+    if datagram is not None:
+        s.sendto(datagram, dest_addr)
+        return
+
+    raw = __raw_chunks(fmeta, cnk_sz)
+    byte, bit = cnk_num // 8, 1 << (cnk_num % 8)
+    known_raw = byte < len(raw) and raw[byte] & bit
+
     #last chunk?
     last_cnk = True if size <= cnk_offset+cnk_sz else False
     # if last chunk returned size must be adjusted
     if last_cnk:
         cnk_sz = size - cnk_offset
 
+    with open(filename, 'rb') as f:
+        f.seek(cnk_offset)
+        data = f.read(cnk_sz)
+    if known_raw:
+        codec, payload = CODEC_RAW, data
+    else:
+        codec, payload = encode_chunk(data, codecs)
+        if codec == CODEC_RAW and codecs & codec_mask([CODEC_ZLIB, CODEC_LZMA]) \
+                and byte < len(raw):
+            # compression was tried and failed
+            raw[byte] |= bit
+
+    datagram = build_chunk_offer(reqfile, size, cnk_offset, cnk_sz,
+        last_cnk, codec, payload, hash_type, offer_type,
+        file_id=fmeta['id'], version=fmeta.get('version', 0))
+    datagram_cache.put(dkey, datagram)
+    s.sendto(datagram, dest_addr)
+
+# Send a CNK_OFFER packet with an already encoded payload
+#
+# used by send_chunk and by clients re-serving chunks
+# they have downloaded
+def send_chunk_payload(s, dest_addr, reqfile, size, cnk_offset, cnk_sz,
+        last_cnk, codec, payload, hash_type=HASH_SHA256,
+        offer_type=CNK_OFFER_CODEC, file_id=0, version=0):
+    s.sendto(build_chunk_offer(reqfile, size, cnk_offset, cnk_sz,
+        last_cnk, codec, payload, hash_type, offer_type, file_id, version), dest_addr)
+
+# Build a ready to send CNK_OFFER, CNK_OFFER_CODEC or
+# CNK_OFFER_ID datagram, file_id and version are used
+# only by the last one
+def build_chunk_offer(reqfile, size, cnk_offset, cnk_sz,
+        last_cnk, codec, payload, hash_type=HASH_SHA256,
+        offer_type=CNK_OFFER_CODEC, file_id=0, version=0):
     # then packet can be built
     # MAGIC
-    # CNK_OFFER <- packet type
+    # CNK_OFFER or CNK_OFFER_CODEC <- packet type
     # name of the file  [short string]
     # total file size   [long]
+    # or
+    # CNK_OFFER_ID <- packet type
+    # file id           [short]
+    # file version      [int]
+    # then
     # chunk offset      [long]
     # chunk size        [long]
     # last chunk        [byte]
-    packet = MAGIC + CNK_OFFER + \
-        serialize_short_str(reqfile) +\
-        i2b(size, limit=8) +\
-        i2b(cnk_offset, limit=8) +\
+    # if not CNK_OFFER:
+    # codec             [byte]
+    # payload length    [int]
+    if offer_type == CNK_OFFER_ID:
+        packet = MAGIC + CNK_OFFER_ID + \
+            i2b(file_id, limit=2) +\
+            i2b(version % 2**32, limit=4)
+    else:
+        packet = MAGIC + offer_type + \
+            serialize_short_str(reqfile) +\
+            i2b(size, limit=8)
+    packet += i2b(cnk_offset, limit=8) +\
         i2b(cnk_sz, limit=8) +\
-        i2b(1 if last_cnk else 0, limit=1) 
-
-    with open(filename, 'rb') as f:
-        f.seek(cnk_offset)
-        # add bytes to packet
-        packet += f.read(cnk_sz)
-
-    # had trailing hash and send
-    __hash_and_send(s, dest_addr, packet, hash_type)
-
+        i2b(1 if last_cnk else 0, limit=1)
+    if offer_type == CNK_OFFER:
+        if codec != CODEC_RAW:
+            raise Exception("CNK_OFFER cannot carry encoded chunks")
+    else:
+        packet += i2b(codec, limit=1) +\
+            i2b(len(payload), limit=4)
+    packet += payload
+
+    # had trailing hash
+    return __hash(packet, hash_type)
+
+
+# last built server hellos, rebuilt only when the
+# catalog (names, sizes and versions of files) changes
+__hello_cache = {
+    SRV_HELLO: (None, None),
+    SRV_HELLO_ID: (None, None),
+}
+
+# Return a ready to send server hello datagram
+def build_server_hello(fmaps, hash_type=HASH_SHA256):
+    key = (hash_type, tuple((name, info['size']) for name,info in fmaps.items()))
+    if __hello_cache[SRV_HELLO][0] != key:
+        packet = MAGIC + SRV_HELLO + serialize_fname_sz_seq(fmaps)
+        __hello_cache[SRV_HELLO] = (key, __hash(packet, hash_type))
+    return __hello_cache[SRV_HELLO][1]
+
+# Return the list of ready to send SRV_HELLO_ID datagrams,
+# the catalog is split so that none exceeds MAX_PACKET_SIZE
+#   flist:  list of file metadata, indexed by file id
+def build_server_hello_by_id(flist, hash_type=HASH_SHA256):
+    key = (hash_type, tuple((info['name'], info['size'], info.get('version', 0), info.get('cnk_size')) for info in flist))
+    if __hello_cache[SRV_HELLO_ID][0] != key:
+        # room left by magic, type, file count and the
+        # longest hash trailer
+        room = conf.MAX_PACKET_SIZE - MAGIC_LENGTH - TYPE_LENGTH - 2 \
+            - HASH_LENGTH - hashlib.sha256().digest_size
+        groups = [[]]
+        used = 0
+        for info in flist:
+            entry = serialize_file_id(info)
+            if used + len(entry) > room:
+                groups.append([])
+                used = 0
+            groups[-1].append(entry)
+            used += len(entry)
+        packets = [__hash(MAGIC + SRV_HELLO_ID + i2b(len(g), limit=2) + b''.join(g), hash_type)
+            for g in groups]
+        __hello_cache[SRV_HELLO_ID] = (key, packets)
+    return __hello_cache[SRV_HELLO_ID][1]
 
 # Build and send a server hello message
 def send_server_hello(s, dest_address, fmaps, hash_type=HASH_SHA256):
-    packet = MAGIC + SRV_HELLO + serialize_fname_sz_seq(fmaps)
-    __hash_and_send(s, dest_address, packet, hash_type)
+    s.sendto(build_server_hello(fmaps, hash_type), dest_address)
 
 # Build and send a client hello message
 def send_client_hello(s, dest_address, hash_type=HASH_SHA256):
     packet = MAGIC + CLN_HELLO
     __hash_and_send(s, dest_address, packet, hash_type)
 
-# build and send a CNK_LIST_REQ message
+# build and send a CNK_LIST_REQ_CODEC message, or an
+# old CNK_LIST_REQ one if codecs is None
 def send_chunk_list_req(s, dest_address,
         remote_file,
         expected_size,
         cnk_list,
-        hash_type=HASH_SHA256):
-    packet = MAGIC + CNK_LIST_REQ +\
+        hash_type=HASH_SHA256,
+        codecs=SUPPORTED_CODECS):
+    packet = MAGIC + (CNK_LIST_REQ if codecs is None else CNK_LIST_REQ_CODEC) +\
         serialize_short_str(remote_file) +\
         i2b(expected_size, limit=8) +\
+        (b'' if codecs is None else i2b(codecs, limit=1)) +\
         i2b(len(cnk_list), limit=4) +\
         b''.join(map(lambda n: i2b(n, limit=8), cnk_list))
         
     __hash_and_send(s, dest_address, packet, hash_type)
 
+# build and send a CNK_LIST_REQ_ID message
+def send_chunk_list_req_by_id(s, dest_address,
+        file_id,
+        version,
+        cnk_list,
+        hash_type=HASH_SHA256,
+        codecs=SUPPORTED_CODECS):
+    packet = MAGIC + CNK_LIST_REQ_ID +\
+        i2b(file_id, limit=2) +\
+        i2b(version % 2**32, limit=4) +\
+        i2b(codecs, limit=1) +\
+        i2b(len(cnk_list), limit=4) +\
+        b''.join(map(lambda n: i2b(n, limit=8), cnk_list))
+
+    __hash_and_send(s, dest_address, packet, hash_type)
+
 # return a tuple
 # (header, parsed packet)
 # throws if packet HASH
 # do not match content
+#
+# packet can be any bytes-like object, a memoryview
+# avoids copies: in that case returned chunk data
+# refer to the same memory
 def parse_packet(packet):
     if len(packet) < 8:
         raise Exception("buffer too short")
@@ -345,7 +842,7 @@ def parse_packet(packet):
         raise Exception("Magic mismatch")
     offset += MAGIC_LENGTH
     # type
-    msg_type = packet[offset:offset+TYPE_LENGTH]
+    msg_type = bytes(packet[offset:offset+TYPE_LENGTH])
     offset += TYPE_LENGTH
     # extract payload
     if msg_type == SRV_HELLO:
@@ -353,9 +850,19 @@ def parse_packet(packet):
     elif msg_type == CLN_HELLO:
         content = None # no data associated with a client hello
     elif msg_type == CNK_OFFER:
-        content, offset = __extract_chunk(packet, offset)
+        content, offset = __extract_chunk(packet, offset, encoded=False)
     elif msg_type == CNK_LIST_REQ:
+        content, offset = __extract_chunk_list_req(packet, offset, encoded=False)
+    elif msg_type == CNK_OFFER_CODEC:
+        content, offset = __extract_chunk(packet, offset)
+    elif msg_type == CNK_LIST_REQ_CODEC:
         content, offset = __extract_chunk_list_req(packet, offset)
+    elif msg_type == SRV_HELLO_ID:
+        content, offset = __extract_file_data_by_id(packet, offset)
+    elif msg_type == CNK_OFFER_ID:
+        content, offset = __extract_chunk_by_id(packet, offset)
+    elif msg_type == CNK_LIST_REQ_ID:
+        content, offset = __extract_chunk_list_req_by_id(packet, offset)
     else:
         raise Exception("Unknown packet type: " + repr(msg_type))
     # check hash type